@@ -34,6 +34,9 @@ makeScript {
       __nixpkgs__.gzip
       __nixpkgs__.nixStable
     ];
+    pythonPackage = [
+      ./src/cli
+    ];
     source = [
       (import ./makes/cli/pypi/main.nix args)
     ];
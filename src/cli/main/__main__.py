@@ -1,27 +1,32 @@
 from contextlib import (
     suppress,
 )
+import errno
 from functools import (
+    lru_cache,
     partial,
 )
 import io
 import json
-import operator
+from main import (
+    config_cache,
+    git,
+)
 from os import (
     environ,
     getcwd,
     makedirs,
-    remove,
+    rename,
+    stat,
+    stat_result,
+    utime,
 )
 from os.path import (
+    abspath,
     commonprefix,
     exists,
-    getctime,
     join,
-)
-from posixpath import (
-    abspath,
-    dirname,
+    normcase,
 )
 import random
 import re
@@ -52,7 +57,6 @@ from typing import (
     Dict,
     List,
     Optional,
-    Set,
     Tuple,
 )
 from urllib.parse import (
@@ -67,7 +71,9 @@ CON: rich.console.Console = rich.console.Console(
 )
 MAKES_DIR: str = join(environ["HOME_IMPURE"], ".makes")
 makedirs(join(MAKES_DIR, "cache"), exist_ok=True)
-SOURCES_CACHE: str = join(MAKES_DIR, "cache", "sources")
+# Bare repositories, the checkouts under cache/sources are no longer used
+SOURCES_CACHE: str = join(MAKES_DIR, "cache", "git")
+CONFIG_CACHE: str = join(MAKES_DIR, "cache", "config")
 ON_EXIT: List[Callable[[], None]] = []
 VERSION: str = "22.03"
 
@@ -185,12 +191,47 @@ EMOJIS_SUCCESS = [
     "whale",  # 🐳
     "wink",  # 😉
 ]
+SOURCE_GITHUB = re.compile(r"^github:(?P<owner>.*)/(?P<repo>.*)@(?P<rev>.*)$")
+SOURCE_GITLAB = re.compile(r"^gitlab:(?P<owner>.*)/(?P<repo>.*)@(?P<rev>.*)$")
+SOURCE_LOCAL = re.compile(r"^local:(?P<path>.*)@(?P<rev>.*)$")
+COMMIT_SHA = re.compile(r"[0-9a-f]{40}")
+# Protocol v2 lets the remote advertise only the refs we ask for
+GIT_FETCH_CONFIG = ["-c", "protocol.version=2"]
+# Short-lived clones never need a garbage collection
+GIT_TEMPORARY_CONFIG = ["-c", "gc.auto=0"]
+# Where a cached repository keeps the fetched revision
+GIT_CACHE_REF = "refs/makes/source"
+OUTPUTS_HIDDEN = frozenset({"__all__", "/secretsForAwsFromEnv/__default__"})
+# Options that are the same for every Nix build of this process
+NIX_BUILD_OPTIONS = [
+    *["--option", "cores", "0"],
+    *([] if NIX_STABLE else ["--impure"]),
+    *["--option", "narinfo-cache-negative-ttl", "1"],
+    *["--option", "narinfo-cache-positive-ttl", "1"],
+    *["--option", "max-jobs", "auto"],
+    *["--option", "sandbox", "false" if K8S_COMPAT else "true"],
+    *["--show-trace"],
+]
 
 
 def _if(condition: Any, *value: Any) -> List[Any]:
     return list(value) if condition else []
 
 
+def _stat(path: str) -> Optional[stat_result]:
+    # Existence and metadata of a path in a single syscall
+    try:
+        return stat(path)
+    except FileNotFoundError:
+        return None
+
+
+@lru_cache(maxsize=8)
+def _is_src_local(src: str) -> bool:
+    # `m .` ?
+    return normcase(abspath(src)) == normcase(CWD)
+
+
 def _clone_src(src: str) -> str:
     # pylint: disable=consider-using-with
     with warnings.catch_warnings():
@@ -198,9 +239,9 @@ def _clone_src(src: str) -> str:
         head = tempfile.TemporaryDirectory(prefix="makes-").name
     ON_EXIT.append(partial(shutil.rmtree, head, ignore_errors=True))
 
-    if abspath(src) == CWD:  # `m .` ?
+    if _is_src_local(src):
         if NIX_STABLE:
-            _clone_src_git_worktree_add(src, head)
+            _clone_src_git_worktree_add(src, head, "HEAD")
         else:
             # Nix with Flakes already ensures a pristine git repo
             head = src
@@ -219,17 +260,47 @@ def _clone_src(src: str) -> str:
             CON.print("Please see the correct usage below", justify="center")
             _help_and_exit_base()
 
+        if cache_key:
+            # Fetch into the cache, then check out from there,
+            # so only the cache ever talks to the remote
+            if not _clone_src_cache_get(src, cache_key, remote, rev):
+                _clone_src_cache_refresh(cache_key, remote, rev)
+            _clone_src_cache_checkout(cache_key, head)
+        else:
+            _clone_src_git(head, remote, rev)
+
+    return head
+
+
+def _is_commit_sha(rev: str) -> bool:
+    return COMMIT_SHA.fullmatch(rev) is not None
+
+
+def _clone_src_git(head: str, remote: str, rev: str) -> None:
+    if _is_commit_sha(rev):
+        # A commit can only be fetched by its hash, not cloned by name
         _clone_src_git_init(head)
-        remote = _clone_src_cache_get(src, cache_key, remote)
         _clone_src_git_fetch(head, remote, rev)
-        _clone_src_git_checkout(head, rev)
-        _clone_src_cache_refresh(head, cache_key)
+        _clone_src_git_reset(head, rev)
+    else:
+        _clone_src_git_clone(head, remote, rev)
 
-    return head
 
+def _clone_src_git_clone(head: str, remote: str, rev: str) -> None:
+    depth = _if(GIT_DEPTH >= 1, f"--depth={GIT_DEPTH}")
+    cmd = [
+        *["git", *GIT_FETCH_CONFIG, *GIT_TEMPORARY_CONFIG, "clone"],
+        *[*depth, "--branch", rev, "--single-branch", "--no-tags"],
+        *[remote, head],
+    ]
+    out, _, _ = _run(cmd, stderr=None, stdout=sys.stderr.fileno())
+    if out != 0:
+        raise SystemExit(out)
 
-def _clone_src_git_init(head: str) -> None:
-    cmd = ["git", "init", "--initial-branch=____", "--shared=false", head]
+
+def _clone_src_git_init(head: str, *options: str) -> None:
+    cmd = ["git", "init", "--initial-branch=____", "--shared=false", *options]
+    cmd.append(head)
     out, _, _ = _run(cmd, stderr=None, stdout=sys.stderr.fileno())
     if out != 0:
         raise SystemExit(out)
@@ -237,27 +308,34 @@ def _clone_src_git_init(head: str) -> None:
 
 def _clone_src_git_fetch(head: str, remote: str, rev: str) -> None:
     depth = _if(GIT_DEPTH >= 1, f"--depth={GIT_DEPTH}")
-    cmd = ["git", "-C", head, "fetch", *depth, remote, f"{rev}:{rev}"]
+    cmd = [
+        *["git", *GIT_FETCH_CONFIG, *GIT_TEMPORARY_CONFIG, "-C", head],
+        *["fetch", "--no-tags", "--no-write-fetch-head", *depth, remote, rev],
+    ]
     out, _, _ = _run(cmd, stderr=None, stdout=sys.stderr.fileno())
     if out != 0:
         raise SystemExit(out)
 
 
-def _clone_src_git_checkout(head: str, rev: str) -> None:
-    cmd = ["git", "-C", head, "checkout", rev]
+def _clone_src_git_reset(head: str, rev: str) -> None:
+    cmd = ["git", "-C", head, "reset", "--hard", rev]
     out, _, _ = _run(cmd, stderr=None, stdout=sys.stderr.fileno())
     if out != 0:
         raise SystemExit(out)
 
 
-def _clone_src_git_worktree_add(remote: str, head: str) -> None:
-    cmd = ["git", "-C", remote, "worktree", "add", head, "HEAD"]
+def _clone_src_git_worktree_add(remote: str, head: str, rev: str) -> None:
+    cmd = ["git", "-C", remote, "worktree", "add", "--detach", head, rev]
     out, _, _ = _run(cmd, stderr=None, stdout=sys.stderr.fileno())
     if out != 0:
         raise SystemExit(out)
     CON.out(head)
 
 
+def _clone_src_git_worktree_prune(remote: str) -> None:
+    _run(["git", "-C", remote, "worktree", "prune"])
+
+
 def _clone_src_apply_registry(src: str) -> str:
     with open(__MAKES_REGISTRY__, encoding="utf-8") as file:
         registry = json.load(file)
@@ -269,9 +347,7 @@ def _clone_src_apply_registry(src: str) -> str:
 
 
 def _clone_src_github(src: str) -> Optional[Tuple[str, str, str]]:
-    regex = r"^github:(?P<owner>.*)/(?P<repo>.*)@(?P<rev>.*)$"
-
-    if match := re.match(regex, src):
+    if match := SOURCE_GITHUB.match(src):
         owner = url_quote(match.group("owner"))
         repo = url_quote(match.group("repo"))
         rev = url_quote(match.group("rev"))
@@ -284,9 +360,7 @@ def _clone_src_github(src: str) -> Optional[Tuple[str, str, str]]:
 
 
 def _clone_src_gitlab(src: str) -> Optional[Tuple[str, str, str]]:
-    regex = r"^gitlab:(?P<owner>.*)/(?P<repo>.*)@(?P<rev>.*)$"
-
-    if match := re.match(regex, src):
+    if match := SOURCE_GITLAB.match(src):
         owner = url_quote(match.group("owner"))
         repo = url_quote(match.group("repo"))
         rev = url_quote(match.group("rev"))
@@ -299,9 +373,7 @@ def _clone_src_gitlab(src: str) -> Optional[Tuple[str, str, str]]:
 
 
 def _clone_src_local(src: str) -> Optional[Tuple[str, str, str]]:
-    regex = r"^local:(?P<path>.*)@(?P<rev>.*)$"
-
-    if match := re.match(regex, src):
+    if match := SOURCE_LOCAL.match(src):
         path = url_quote(match.group("path"))
         rev = url_quote(match.group("rev"))
         remote = f"file://{path}"
@@ -312,26 +384,82 @@ def _clone_src_local(src: str) -> Optional[Tuple[str, str, str]]:
     return None
 
 
-def _clone_src_cache_get(src: str, cache_key: str, remote: str) -> str:
+def _clone_src_cache_get(
+    src: str,
+    cache_key: str,
+    remote: str,
+    rev: str,
+) -> bool:
     cached: str = join(SOURCES_CACHE, cache_key)
-    if cache_key:
-        if exists(cached):
-            cached_since: float = time() - getctime(cached)
-            if cached_since <= 86400.0:
-                CON.out(f"Cached from {cached}")
-                remote = cached
-            else:
-                shutil.rmtree(cached)
-        else:
-            CON.out(f"From {src}")
+    if (cached_stat := _stat(cached)) is not None:
+        cached_since: float = time() - cached_stat.st_ctime
+        # A commit is immutable, its cache never expires
+        if (
+            _is_commit_sha(rev)
+            or cached_since <= 86400.0
+            or _clone_src_cache_update(cached, remote, rev)
+        ):
+            CON.out(f"Cached from {cached}")
+            return True
+        shutil.rmtree(cached)
+
+    CON.out(f"From {src}")
+    return False
 
-    return remote
 
+def _clone_src_cache_update(cached: str, remote: str, rev: str) -> bool:
+    # Bring an expired cache up to date in-place instead of re-cloning it,
+    # the cache is bare so only its ref moves, there is no index to reset
+    if _clone_src_cache_fetch(cached, remote, rev) != 0:
+        return False
 
-def _clone_src_cache_refresh(head: str, cache_key: str) -> None:
+    # Drop what only older revisions used, so the cache does not grow.
+    # Pruning keeps the default grace period, other runs may be reading
+    # objects of the previous revision from this very cache
+    cmd = ["git", "-C", cached, "gc", "--quiet"]
+    out, _, _ = _run(cmd, stderr=None, stdout=sys.stderr.fileno())
+    if out != 0:
+        return False
+
+    utime(cached)
+    return True
+
+
+def _clone_src_cache_refresh(cache_key: str, remote: str, rev: str) -> None:
+    # Fetch next to the cache and move it in place once complete,
+    # so an interrupted fetch never looks like a valid cache.
+    # The cache is bare, it keeps no working tree of its own
+    makedirs(SOURCES_CACHE, exist_ok=True)
+    fetching: str = tempfile.mkdtemp(prefix=f"{cache_key}-", dir=SOURCES_CACHE)
+    ON_EXIT.append(partial(shutil.rmtree, fetching, ignore_errors=True))
+
+    _clone_src_git_init(fetching, "--bare")
+    if (out := _clone_src_cache_fetch(fetching, remote, rev)) != 0:
+        raise SystemExit(out)
+    try:
+        rename(fetching, join(SOURCES_CACHE, cache_key))
+    except OSError as error:
+        # A concurrent run filled the cache first, it is just as good
+        if error.errno not in {errno.EEXIST, errno.ENOTEMPTY}:
+            raise
+
+
+def _clone_src_cache_fetch(cached: str, remote: str, rev: str) -> int:
+    depth = _if(GIT_DEPTH >= 1, f"--depth={GIT_DEPTH}")
+    cmd = [
+        *["git", *GIT_FETCH_CONFIG, "-C", cached, "fetch", "--no-tags"],
+        *["--no-write-fetch-head", *depth, remote, f"+{rev}:{GIT_CACHE_REF}"],
+    ]
+    out, _, _ = _run(cmd, stderr=None, stdout=sys.stderr.fileno())
+    return out
+
+
+def _clone_src_cache_checkout(cache_key: str, head: str) -> None:
+    # A worktree reads the objects of the cache, none is copied to head
     cached: str = join(SOURCES_CACHE, cache_key)
-    if cache_key and not exists(cached):
-        shutil.copytree(head, cached)
+    _clone_src_git_worktree_add(cached, head, GIT_CACHE_REF)
+    # Runs after head is removed, so the cache forgets about it
+    ON_EXIT.append(partial(_clone_src_git_worktree_prune, cached))
 
 
 def _nix_build(
@@ -347,8 +475,8 @@ def _nix_build(
             "cache.nixos.org-1:6NCHdD59X431o0gWypbMrAURkbJ16ZPMQFGspcDShjY="
         )
     else:
-        substituters = " ".join(map(operator.itemgetter("url"), cache))
-        trusted_pub_keys = " ".join(map(operator.itemgetter("pubKey"), cache))
+        substituters = " ".join(config["url"] for config in cache)
+        trusted_pub_keys = " ".join(config["pubKey"] for config in cache)
 
     return [
         *_if(NIX_STABLE, f"{__NIX_STABLE__}/bin/nix-build"),
@@ -358,22 +486,28 @@ def _nix_build(
         *_if(NIX_STABLE, "--argstr", "makesSrc", __MAKES_SRC__),
         *_if(NIX_STABLE, "--argstr", "projectSrc", head),
         *_if(NIX_STABLE, "--attr", attr),
-        *["--option", "cores", "0"],
-        *_if(not NIX_STABLE, "--impure"),
-        *["--option", "narinfo-cache-negative-ttl", "1"],
-        *["--option", "narinfo-cache-positive-ttl", "1"],
-        *["--option", "max-jobs", "auto"],
+        *NIX_BUILD_OPTIONS,
         *["--option", "substituters", substituters],
         *["--option", "trusted-public-keys", trusted_pub_keys],
-        *["--option", "sandbox", "false" if K8S_COMPAT else "true"],
         *_if(out, "--out-link", out),
         *_if(not out, "--no-out-link"),
-        *["--show-trace"],
         *_if(NIX_STABLE, f"{__MAKES_SRC__}/src/evaluator/default.nix"),
         *_if(not NIX_STABLE, attr),
     ]
 
 
+def _nix_eval_json(*, attr: str, head: str) -> List[str]:
+    return [
+        f"{__NIX_STABLE__}/bin/nix-instantiate",
+        *["--eval", "--json", "--strict"],
+        *["--argstr", "makesSrc", __MAKES_SRC__],
+        *["--argstr", "projectSrc", head],
+        *["--attr", attr],
+        *NIX_BUILD_OPTIONS,
+        f"{__MAKES_SRC__}/src/evaluator/default.nix",
+    ]
+
+
 def _get_head(src: str) -> str:
     # Checkout repository HEAD into a temporary directory
     # This is nice for reproducibility and security,
@@ -384,33 +518,8 @@ def _get_head(src: str) -> str:
     head: str = _clone_src(src)
 
     # Applies only to local repositories on non-flakes Nix
-    if abspath(src) == CWD and NIX_STABLE:  # `m .` ?
-        paths: Set[str] = set()
-
-        # Propagated `git add`ed files
-        cmd = ["git", "-C", src, "diff", "--cached", "--name-only"]
-        out, stdout, _ = _run(cmd, stderr=None)
-        if out != 0:
-            raise SystemExit(out)
-        paths.update(stdout.decode().splitlines())
-
-        # Propagated modified files
-        cmd = ["git", "-C", src, "ls-files", "--modified"]
-        out, stdout, _ = _run(cmd, stderr=None)
-        if out != 0:
-            raise SystemExit(out)
-        paths.update(stdout.decode().splitlines())
-
-        # Copy paths to head
-        for path in sorted(paths):
-            dest = join(head, path)
-            path = join(src, path)
-            if not exists(dirname(dest)):
-                makedirs(dirname(dest))
-            if exists(path):
-                shutil.copy(path, dest)
-            else:
-                remove(dest)
+    if _is_src_local(src) and NIX_STABLE:
+        git.copy_changes(src, head)
 
     return head
 
@@ -419,17 +528,50 @@ def _get_config(head: str) -> Dict[str, Any]:
     CON.out()
     CON.rule("Building project configuration")
     CON.out()
-    out: str = tempfile.mktemp()  # nosec
+    fingerprint: str = config_cache.fingerprint(
+        head, salt=(VERSION, __MAKES_SRC__, str(NIX_STABLE))
+    )
+    if (config := config_cache.get(CONFIG_CACHE, fingerprint)) is not None:
+        CON.out(f"Cached from {CONFIG_CACHE}")
+        return config
+
+    if NIX_STABLE:
+        config = _get_config_from_eval(head)
+    else:
+        config = _get_config_from_build(head)
+    config_cache.put(CONFIG_CACHE, fingerprint, config)
+
+    return config
+
+
+def _get_config_from_eval(head: str) -> Dict[str, Any]:
+    # The configuration is plain data, evaluating it is enough,
+    # there is no need to realize a JSON file into the store
+    code, stdout, _ = _run(
+        args=_nix_eval_json(attr="config.config", head=head),
+        stderr=None,
+    )
+
+    if code == 0:
+        return json.loads(stdout)
+
+    raise SystemExit(code)
+
+
+def _get_config_from_build(head: str) -> Dict[str, Any]:
+    # Flakes of projects pinned to any Makes release expose
+    # the configuration only as a derivation
+    out_dir: str = tempfile.mkdtemp(prefix="makes-")
+    ON_EXIT.append(partial(shutil.rmtree, out_dir, ignore_errors=True))
+    out: str = join(out_dir, "config.json")
     code, _, _, = _run(
         args=_nix_build(
-            attr="config.configAsJson"
-            if NIX_STABLE
-            else f'{head}#__makes__."config:configAsJson"',
+            attr=f'{head}#__makes__."config:configAsJson"',
             cache=None,
             head=head,
             out=out,
         ),
-        env=None if NIX_STABLE else dict(HOME=environ["HOME_IMPURE"]),
+        env=dict(HOME=environ["HOME_IMPURE"]),
         stderr=None,
         stdout=sys.stderr.fileno(),
     )
@@ -506,13 +648,9 @@ def _help_and_exit_with_src_no_tty(src: str, attrs: List[str]) -> None:
     CON.print(rich.panel.Panel.fit(text), justify="center")
     CON.out()
 
-    text = "Can be:\n\n"
-    for attr in attrs:
-        if attr not in {
-            "__all__",
-            "/secretsForAwsFromEnv/__default__",
-        }:
-            text += f"    {attr}\n"
+    text = "Can be:\n\n" + "".join(
+        f"    {attr}\n" for attr in attrs if attr not in OUTPUTS_HIDDEN
+    )
     CON.print(rich.panel.Panel(text, title="OUTPUT"))
     CON.out()
 
@@ -795,8 +933,11 @@ def execute_action(args: List[str], head: str, out: str) -> None:
 
 
 def cache_push(cache: List[Dict[str, str]], out: str) -> None:
+    if "CACHIX_AUTH_TOKEN" not in environ:
+        return
+
     for config in cache:
-        if config["type"] == "cachix" and "CACHIX_AUTH_TOKEN" in environ:
+        if config["type"] == "cachix":
             CON.out("Pushing to cache")
             _run(
                 args=["cachix", "push", "-c", "0", config["name"], out],
@@ -0,0 +1,97 @@
+from contextlib import (
+    suppress,
+)
+from functools import (
+    partial,
+)
+import hashlib
+import json
+from main import (
+    git,
+)
+from os import (
+    lstat,
+    makedirs,
+    readlink,
+    remove,
+    replace,
+    scandir,
+    stat,
+)
+from os.path import (
+    join,
+)
+from stat import (
+    S_ISLNK,
+    S_ISREG,
+)
+import tempfile
+from time import (
+    time,
+)
+from typing import (
+    Any,
+    Dict,
+    Iterable,
+    Optional,
+)
+
+TTL: float = 86400.0
+
+
+def fingerprint(head: str, salt: Iterable[str]) -> str:
+    # Everything the project configuration can depend on:
+    # the Makes framework itself and the files that Nix sees from the project
+    digest = hashlib.sha256()
+    for item in salt:
+        digest.update(item.encode())
+        digest.update(b"\0")
+
+    # Committed files are identified by their blob ids, no need to read them
+    digest.update(git.run(head, "ls-files", "-z", "--stage"))
+
+    # Only files that differ from the index are read, in chunks.
+    # Untracked files never reach Nix, they are left out
+    for code, path, orig_path in git.status(head):
+        digest.update(f"{code} {path} {orig_path}\0".encode())
+        _hash_path(digest, join(head, path))
+
+    return digest.hexdigest()
+
+
+def _hash_path(digest: Any, path: str) -> None:
+    with suppress(FileNotFoundError):
+        path_stat = lstat(path)
+        if S_ISLNK(path_stat.st_mode):
+            digest.update(readlink(path).encode())
+        elif S_ISREG(path_stat.st_mode):
+            with open(path, "rb") as file:
+                for chunk in iter(partial(file.read, 65536), b""):
+                    digest.update(chunk)
+
+
+def get(cache: str, key: str) -> Optional[Dict[str, Any]]:
+    cached: str = join(cache, f"{key}.json")
+    with suppress(FileNotFoundError):
+        if time() - stat(cached).st_ctime <= TTL:
+            with open(cached, encoding="utf-8") as file:
+                return json.load(file)
+        remove(cached)
+
+    return None
+
+
+def put(cache: str, key: str, config: Dict[str, Any]) -> None:
+    makedirs(cache, exist_ok=True)
+    # Every edited tree has its own entry, drop the ones that expired
+    with scandir(cache) as entries:
+        for entry in entries:
+            with suppress(FileNotFoundError):
+                if time() - entry.stat().st_ctime > TTL:
+                    remove(entry.path)
+
+    with tempfile.NamedTemporaryFile(
+        mode="w", encoding="utf-8", dir=cache, delete=False
+    ) as file:
+        json.dump(config, file)
+    replace(file.name, join(cache, f"{key}.json"))
@@ -0,0 +1,101 @@
+from contextlib import (
+    suppress,
+)
+from os import (
+    remove,
+)
+from os.path import (
+    join,
+)
+import subprocess  # nosec
+import tempfile
+from typing import (
+    Iterator,
+    List,
+    Optional,
+    Set,
+    Tuple,
+)
+
+
+def run(repo: str, *args: str, stdin: Optional[bytes] = None) -> bytes:
+    process = subprocess.run(  # nosec
+        args=["git", "-C", repo, *args],
+        check=False,
+        input=stdin,
+        shell=False,
+        stdout=subprocess.PIPE,
+    )
+    if process.returncode != 0:
+        raise SystemExit(process.returncode)
+
+    return process.stdout
+
+
+def status(repo: str) -> Iterator[Tuple[str, str, str]]:
+    # Tracked paths that differ from HEAD, in a single `git` call.
+    # Entries are `XY PATH`, renames and copies append `ORIG_PATH`,
+    # in the index (X) or, for intent-to-add paths, the worktree (Y)
+    stdout = run(repo, "status", "-z", "--porcelain=v1", "-uno")
+    entries = iter(stdout.decode().split("\0"))
+    for entry in entries:
+        if entry:
+            code, path = entry[0:2], entry[3:]
+            renamed = "R" in code or "C" in code
+            yield code, path, next(entries) if renamed else ""
+
+
+def copy_changes(src: str, head: str) -> None:
+    # Propagate `git add`ed and modified files from src to head.
+    # The status tells deletions apart, no need to stat every path
+    copied: Set[str] = set()
+    removed: Set[str] = set()
+    for code, path, orig_path in status(src):
+        (removed if "D" in code else copied).add(path)
+        if "R" in code:
+            removed.add(orig_path)
+
+    # Remove deleted paths from head, they may not exist there at all
+    for path in sorted(removed - copied):
+        with suppress(FileNotFoundError):
+            remove(join(head, path))
+
+    if copied:
+        paths: List[str] = sorted(copied)
+        _copy_paths(src, head, paths)
+        # Added files are tracked in head as well, so its status lists them
+        run(
+            *[head, "add", "--force", "--intent-to-add"],
+            *["--pathspec-from-file=-", "--pathspec-file-nul"],
+            stdin="\0".join(paths).encode(),
+        )
+
+
+def _copy_paths(src: str, dest: str, paths: List[str]) -> None:
+    # The archive is piped between both `tar`s by the kernel,
+    # it is never buffered in Python memory
+    with tempfile.TemporaryFile() as files:
+        files.write("\0".join(paths).encode())
+        files.seek(0)
+
+        with subprocess.Popen(
+            args=[
+                *["tar", "-C", src, "--null", "--no-recursion"],
+                *["-T", "-", "-cf", "-"],
+            ],
+            shell=False,  # nosec
+            stdin=files,
+            stdout=subprocess.PIPE,
+        ) as create:
+            with subprocess.Popen(
+                args=["tar", "-C", dest, "-xf", "-"],
+                shell=False,  # nosec
+                stdin=create.stdout,
+            ) as extract:
+                # So `create` gets a SIGPIPE if `extract` exits early
+                if create.stdout is not None:
+                    create.stdout.close()
+
+    for code in (create.returncode, extract.returncode):
+        if code != 0:
+            raise SystemExit(code)